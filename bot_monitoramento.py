@@ -1,18 +1,29 @@
 import os
+import hashlib
+import logging
 import time
-import socket
-import pandas as pd
+import threading
 import requests
-import schedule
-from datetime import datetime
+from datetime import datetime, timedelta
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine.url import URL
+from requests.adapters import HTTPAdapter
+from sqlalchemy import text
+from sqlalchemy.engine import Row
+from urllib3.util.retry import Retry
 from zoneinfo import ZoneInfo  # Python 3.9+
 
+from db import run_query_rows, wait_for_vpn_and_db
+
 # === Fuso horário oficial do bot ===
 TZ = ZoneInfo("America/Fortaleza")
 
+# === Log único do bot (timestamp + traceback nos erros) ===
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+log = logging.getLogger("esteiras")
+
 # === Carrega variáveis do .env ===
 load_dotenv()
 
@@ -21,218 +32,185 @@ SLACK_TOKEN = os.getenv("SLACK_TOKEN")
 # Canal das esteiras
 SLACK_CHANNEL_ESTEIRAS = "#monitoramento-privado"
 
-DB_CFG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(os.getenv("DB_PORT", 5432)),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
-
-# === Query Produto NOVO (esteiras) ===
-SQL_NOVO = """
+# Sessão Slack única: keep-alive (sem novo handshake TLS a cada post) + retry
+_SLACK = requests.Session()
+_SLACK.headers["Authorization"] = f"Bearer {SLACK_TOKEN}"
+_SLACK.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+))
+
+# === Query esteiras (NOVO, REFIN e PORTABILITY numa única varredura) ===
+SQL_ALL = """
+with latest as (
+  -- Último log do dia por contrato: um único sort-distinct em vez de um LATERAL por contrato
+  select distinct on (contractid)
+    contractid,
+    operationsteptype,
+    logdate
+  from tudoprod.operationsteplog
+  where logdate >= :inicio
+    and logdate <  :fim
+  order by contractid, logdate desc
+)
 select
+  cl.loantype,
   oo.operationsteptype as last_steptype,
   count(*) as qtd,
-  sum(cl.grossvalue) as sum_gross
+  sum(cl.grossvalue)::float8 as sum_gross  -- float no driver (evita Decimal por linha)
 from tudoprod.contract cc
 join tudoprod.enrollment ee
   on cc.enrollmentid = ee.id
  and ee.agreementid = '10'
 join tudoprod.contractloan cl
   on cl.contractid = cc.id
- and cl.loantype = 'NEW'
-left join lateral (
-  select *
-  from tudoprod.operationsteplog oo
-  where oo.contractid = cc.id
-  order by oo.logdate desc
-  limit 1
-) oo on true
-where (oo.logdate at time zone 'America/Fortaleza')::date =
-      (now() at time zone 'America/Fortaleza')::date
-group by oo.operationsteptype
-order by count(*) desc;
+ and cl.loantype in ('NEW', 'REFIN', 'PORTABILITY')
+left join latest oo
+  on oo.contractid = cc.id
+where oo.logdate >= :inicio
+  and oo.logdate <  :fim
+group by cl.loantype, oo.operationsteptype
+order by cl.loantype, count(*) desc;
 """
 
-# === Query Produto REFIN (esteiras) ===
-SQL_REFIN = """
-select
-  oo.operationsteptype as last_steptype,
-  count(*) as qtd,
-  sum(cl.grossvalue) as sum_gross
-from tudoprod.contract cc
-join tudoprod.enrollment ee
-  on cc.enrollmentid = ee.id
- and ee.agreementid = '10'
-join tudoprod.contractloan cl
-  on cl.contractid = cc.id
- and cl.loantype = 'REFIN'
-left join lateral (
-  select *
-  from tudoprod.operationsteplog oo
-  where oo.contractid = cc.id
-  order by oo.logdate desc
-  limit 1
-) oo on true
-where (oo.logdate at time zone 'America/Fortaleza')::date =
-      (now() at time zone 'America/Fortaleza')::date
-group by oo.operationsteptype
-order by count(*) desc;
-"""
+# Statement compilado uma vez no import e reaproveitado a cada execução
+STMT_ALL = text(SQL_ALL)
 
-# === Query Produto PORTABILITY (esteiras) ===
-SQL_PORTABILITY = """
-select
-  oo.operationsteptype as last_steptype,
-  count(*) as qtd,
-  sum(cl.grossvalue) as sum_gross
-from tudoprod.contract cc
-join tudoprod.enrollment ee
-  on cc.enrollmentid = ee.id
- and ee.agreementid = '10'
-join tudoprod.contractloan cl
-  on cl.contractid = cc.id
- and cl.loantype = 'PORTABILITY'
-left join lateral (
-  select *
-  from tudoprod.operationsteplog oo
-  where oo.contractid = cc.id
-  order by oo.logdate desc
-  limit 1
-) oo on true
-where (oo.logdate at time zone 'America/Fortaleza')::date =
-      (now() at time zone 'America/Fortaleza')::date
-group by oo.operationsteptype
-order by count(*) desc;
-"""
+# === Cache do resultado das esteiras (compartilhado entre os 3 jobs) ===
+_CACHE = {"ts": None, "rows": None}
+_CACHE_LOCK = threading.Lock()
 
-# ============================================
-# Função para garantir que a VPN/DB esteja acessível
-# ============================================
-def wait_for_vpn_and_db(host: str, port: int = 5432, interval: int = 900):
+def get_all_esteiras(max_age_s: int = 1500) -> list[Row]:
     """
-    interval = 900s = 15 minutos
+    Reexecuta SQL_ALL apenas se o resultado em cache tiver mais de max_age_s segundos.
+    25 min (< intervalo do NOVO, 30 min): só o NOVO renova a consulta; REFIN (40) e
+    PORTABILITY (50) sempre caem em até 20 min de um NOVO e reaproveitam o cache.
     """
-    print(f"[BOOT] Verificando acesso ao DB ({host}:{port})...")
+    with _CACHE_LOCK:
+        ts = _CACHE["ts"]
+        if ts is None or time.monotonic() - ts > max_age_s:
+            # Dia corrente em America/Fortaleza como faixa [inicio, fim) de parâmetros
+            inicio = datetime.now(TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+            _CACHE["rows"] = run_query_rows(STMT_ALL, inicio=inicio, fim=inicio + timedelta(days=1))
+            _CACHE["ts"] = time.monotonic()
+        return _CACHE["rows"]
 
-    while True:
-        try:
-            with socket.create_connection((host, port), timeout=5):
-                print("[BOOT] Banco/VPN acessível. Seguindo execução.")
-                return
-        except OSError:
-            agora = datetime.now(TZ).strftime("%d/%m/%Y %H:%M:%S")
-            print(f"[{agora}] Banco ainda inacessível (VPN desligada?). Nova tentativa em 15 minutos...")
-            time.sleep(interval)
-
-# === Execução SQL (Postgres / tudoprod) ===
-def run_query(sql: str) -> pd.DataFrame:
-    wait_for_vpn_and_db(DB_CFG["host"], DB_CFG["port"])
-
-    url = URL.create(
-        drivername="postgresql+psycopg2",
-        username=DB_CFG["user"],
-        password=DB_CFG["password"],
-        host=DB_CFG["host"],
-        port=DB_CFG["port"],
-        database=DB_CFG["dbname"],
-    )
-    engine = create_engine(url, pool_pre_ping=True)
+def filtrar_produto(rows: list[Row], loantype: str) -> list[Row]:
+    return [r for r in rows if r.loantype == loantype]
 
-    with engine.begin() as conn:
-        df = pd.read_sql(text(sql), conn)
+# === Formatação monetária (R$ 1.234,56) ===
+# Troca "," <-> "." numa única passada (str.translate, em C)
+_BRL_TT = str.maketrans({",": ".", ".": ","})
 
-    engine.dispose()
-    return df
+def format_brl(value) -> str:
+    return ("R$ " + f"{float(value):,.2f}").translate(_BRL_TT)
 
 # === Envio ao Slack — esteiras (por produto) ===
-def post_to_slack(df: pd.DataFrame, produto_label: str):
+# Hash do último conteúdo enviado por produto (em memória, por processo)
+_LAST_HASH: dict[str, str] = {}
+
+def post_to_slack(rows: list[Row], produto_label: str) -> bool:
+    """Retorna True só se a mensagem foi de fato postada no Slack."""
+    # Sem registros: não posta nada (evita spam de mensagens vazias)
+    if not rows:
+        log.info("Sem registros para o dia atual (%s). Post ignorado.", produto_label)
+        return False
+
     agora = datetime.now(TZ).strftime("%d/%m/%Y %H:%M")
     header = (
         f"*Monitoramento de Esteiras — {produto_label}*\n"
         f"📅 {agora} (America/Fortaleza)\n\n"
     )
 
-    if df.empty:
-        text = header + "_Sem registros para o dia atual._"
-    else:
-        lines = [
-            f"• `{r['last_steptype']}` — {int(r['qtd'])} contratos — R$ {float(r['sum_gross']):,.2f}"
-            .replace(",", "X").replace(".", ",").replace("X", ".")
-            for _, r in df.iterrows()
-        ]
-        text = header + "\n".join(lines)
-
-    r = requests.post(
+    lines = [
+        f"• `{r.last_steptype}` — {r.qtd} contratos — {format_brl(r.sum_gross)}"
+        for r in rows
+    ]
+    body = "\n".join(lines)
+
+    # Mesmo conteúdo do último post (ignorando o horário do header): não repete no Slack
+    h = hashlib.blake2b(body.encode(), digest_size=8).hexdigest()
+    if _LAST_HASH.get(produto_label) == h:
+        log.info("Sem mudanças desde o último envio (%s). Post ignorado.", produto_label)
+        return False
+
+    r = _SLACK.post(
         "https://slack.com/api/chat.postMessage",
-        headers={"Authorization": f"Bearer {SLACK_TOKEN}"},
-        json={"channel": SLACK_CHANNEL_ESTEIRAS, "text": text, "mrkdwn": True},
+        json={"channel": SLACK_CHANNEL_ESTEIRAS, "text": header + body, "mrkdwn": True},
         timeout=20,
     )
     if not r.ok or not r.json().get("ok"):
-        print("Erro ao enviar mensagem para o Slack (esteiras):", r.text)
-
-# === Janela de execução esteiras: 06:00–20:00, exceto domingo ===
-def dentro_da_janela_execucao(agora: datetime) -> bool:
-    if agora.weekday() == 6:  # domingo
+        log.error("Erro ao enviar mensagem para o Slack (esteiras): %s", r.text)
         return False
-    return 6 <= agora.hour < 20
-
-# === Jobs Esteiras ===
-def job_novo():
-    agora = datetime.now(TZ)
-    if not dentro_da_janela_execucao(agora):
-        print(f"[{agora}] [NOVO] Fora da janela. Aguardando próxima execução.")
-        return
-    try:
-        print(f"[{agora}] [NOVO] Iniciando...")
-        df = run_query(SQL_NOVO)
-        post_to_slack(df, "Produto NOVO (Consignado Privado)")
-        print(f"[{agora}] [NOVO] Enviado com sucesso!")
-    except Exception as e:
-        print(f"[{agora}] [NOVO] ❌ Erro: {e}")
-
-def job_refin():
-    agora = datetime.now(TZ)
-    if not dentro_da_janela_execucao(agora):
-        print(f"[{agora}] [REFIN] Fora da janela. Aguardando próxima execução.")
-        return
-    try:
-        print(f"[{agora}] [REFIN] Iniciando...")
-        df = run_query(SQL_REFIN)
-        post_to_slack(df, "Produto REFIN (Consignado Privado)")
-        print(f"[{agora}] [REFIN] Enviado com sucesso!")
-    except Exception as e:
-        print(f"[{agora}] [REFIN] ❌ Erro: {e}")
-
-def job_portability():
-    agora = datetime.now(TZ)
-    if not dentro_da_janela_execucao(agora):
-        print(f"[{agora}] [PORTABILITY] Fora da janela. Aguardando próxima execução.")
-        return
-    try:
-        print(f"[{agora}] [PORTABILITY] Iniciando...")
-        df = run_query(SQL_PORTABILITY)
-        post_to_slack(df, "Produto PORTABILITY (Consignado Privado)")
-        print(f"[{agora}] [PORTABILITY] Enviado com sucesso!")
-    except Exception as e:
-        print(f"[{agora}] [PORTABILITY] ❌ Erro: {e}")
+    _LAST_HASH[produto_label] = h
+    return True
+
+# === Jobs Esteiras (um por produto, mesmo caminho de código) ===
+def make_job(loantype: str, tag: str, produto_label: str):
+    def job():
+        try:
+            log.info("[%s] Iniciando...", tag)
+            rows = filtrar_produto(get_all_esteiras(), loantype)
+            if post_to_slack(rows, produto_label):
+                log.info("[%s] Enviado com sucesso!", tag)
+        except Exception:
+            log.exception("[%s] ❌ Erro", tag)
+    return job
 
 # === AGENDAMENTOS ESTEIRAS ===
 
-schedule.every(30).minutes.do(job_novo)          # NOVO: 30 min
-schedule.every(40).minutes.do(job_refin)         # REFIN: 40 min
-schedule.every(50).minutes.do(job_portability)   # PORTABILITY: 50 min
+# Garante VPN/DB uma única vez no boot (o pool cuida das reconexões)
+wait_for_vpn_and_db()
+
+# Host suspenso/ocupado no horário: roda atrasado (até 1h) em vez de descartar; atrasos acumulados viram 1 execução
+sched = BlockingScheduler(
+    timezone=TZ,
+    job_defaults={"misfire_grace_time": 3600, "coalesce": True},
+)
+
+# Roda uma vez ao iniciar (next_run_time=agora) e depois no intervalo de cada produto
+_boot = datetime.now(TZ)
+sched.add_job(  # NOVO: 30 min
+    make_job("NEW", "NOVO", "Produto NOVO (Consignado Privado)"),
+    IntervalTrigger(minutes=30, timezone=TZ), id="novo", next_run_time=_boot,
+)
+sched.add_job(  # REFIN: 40 min
+    make_job("REFIN", "REFIN", "Produto REFIN (Consignado Privado)"),
+    IntervalTrigger(minutes=40, timezone=TZ), id="refin", next_run_time=_boot,
+)
+sched.add_job(  # PORTABILITY: 50 min
+    make_job("PORTABILITY", "PORTABILITY", "Produto PORTABILITY (Consignado Privado)"),
+    IntervalTrigger(minutes=50, timezone=TZ), id="portability", next_run_time=_boot,
+)
+
+ESTEIRAS_JOB_IDS = ("novo", "refin", "portability")
+
+# === Janela de execução esteiras: 06:00–20:00, exceto domingo ===
+def abrir_janela():
+    for job_id in ESTEIRAS_JOB_IDS:
+        sched.resume_job(job_id)
+    log.info("Janela aberta: esteiras retomadas.")
+
+def fechar_janela():
+    for job_id in ESTEIRAS_JOB_IDS:
+        sched.pause_job(job_id)
+    log.info("Janela fechada: esteiras pausadas até a próxima abertura.")
+
+sched.add_job(abrir_janela, CronTrigger(day_of_week="mon-sat", hour=6, minute=0, timezone=TZ))
+sched.add_job(fechar_janela, CronTrigger(hour=20, minute=0, timezone=TZ))
 
-print("⏰ Bot Monitoramento Esteiras Privado iniciado.")
-print("   Esteiras: NOVO(30min) | REFIN(40min) | PORT(50min) — 06:00–20:00, exceto domingos.")
+# Subiu fora da janela: começa pausado e só retoma às 06:00
+if _boot.weekday() == 6 or not 6 <= _boot.hour < 20:
+    fechar_janela()
 
-# Rodar uma vez ao iniciar (opcional)
-job_novo()
-job_refin()
-job_portability()
+log.info("⏰ Bot Monitoramento Esteiras Privado iniciado.")
+log.info("Esteiras: NOVO(30min) | REFIN(40min) | PORT(50min) — 06:00–20:00, exceto domingos.")
 
-while True:
-    schedule.run_pending()
-    time.sleep(30)
+sched.start()
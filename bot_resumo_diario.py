@@ -1,74 +1,61 @@
 import os
-import time
-import socket
+import logging
+import hashlib
 import pandas as pd
 import requests
-import schedule
 from datetime import datetime
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine.url import URL
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from zoneinfo import ZoneInfo  # Python 3.9+
 
+from db import run_query, wait_for_vpn_and_db
+
 # === Fuso horário oficial do bot ===
 TZ = ZoneInfo("America/Fortaleza")
 
+# === Log único do bot (timestamp + traceback nos erros) ===
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+log = logging.getLogger("resumo")
+
 # === Carrega variáveis do .env ===
 load_dotenv()
 
 SLACK_TOKEN = os.getenv("SLACK_TOKEN")
 SLACK_CHANNEL = "#geral-ops-privado"
 
-DB_CFG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(os.getenv("DB_PORT", 5432)),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
+# Sessão Slack única: keep-alive (sem novo handshake TLS a cada post) + retry
+_SLACK = requests.Session()
+_SLACK.headers["Authorization"] = f"Bearer {SLACK_TOKEN}"
+_SLACK.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+))
 
 # === Query Resumo Diário Privado ===
+# flag_paid, data_pagamento e produto já vêm pré-calculados na materialized view
+# gold.mv_cor_contrato_pagamentos (ver sql/mv_cor_contrato_pagamentos.sql)
 SQL_RESUMO = """
-WITH base AS (
-    SELECT 
-        OD.*,
-        cc.contractid,
-        ee.agreementid,
-
-        -- Flag contrato pago 
-        CASE 
-            WHEN OD.info_etapa IN ('5. Pago','6. Pago','7. Pago') THEN 1 
-            ELSE 0 
-        END AS flag_paid,
-
-        -- Data de pagamento
-        CASE 
-            WHEN OD.loanstatus = 'PAID' AND OD.prod = 'PORTABILITY' THEN OD.paid_date
-            WHEN OD.loanstatus = 'PAID' AND OD.paymentdate IS NULL THEN OD.paid_date
-            ELSE OD.paymentdate - INTERVAL 3 HOUR
-        END AS data_pagamento,
-
-        -- Produto normalizado
-        CASE 
-            WHEN OD.prod IN ('PIX_CONSIGNED','FUTUREMARGIN','NEW_PRIVATE_CONSIGNMENT') THEN 'NEW'
-            WHEN OD.prod IN ('REFIN_PRIVATE_CONSIGNMENT') THEN 'REFIN'
-            WHEN OD.prod IN ('PORTABILITY','PORTABILITY_PRIVATE_CONSIGNMENT') THEN 'PORTABILITY'
-            ELSE OD.prod
-        END AS produto
-
-    FROM gold.cor_contrato_operacoes_movimento OD
-    JOIN gold.tudoprod_contract cc 
-      ON cc.contractid = OD.contractid
-    JOIN gold.tudoprod_enrollment ee 
-      ON ee.id = cc.enrollmentid
-    WHERE ee.agreementid = '10'          -- consignado privado
-),
-
 -- Apenas produtos de interesse
-filtro AS (
+WITH filtro AS (
     SELECT *
-    FROM base
+    FROM gold.mv_cor_contrato_pagamentos
     WHERE produto IN ('NEW','REFIN','PORTABILITY')
+      -- Pré-filtro em faixas (sem DATE()/DATE_TRUNC() nas colunas) p/ permitir índice:
+      -- só interessa o que foi concluído no mês ou pago a partir de hoje
+      AND (
+            completeddate  >= DATE_TRUNC('month', CURRENT_DATE)
+         OR data_pagamento >= CURRENT_DATE
+      )
 ),
 
 -- Agregação por produto
@@ -79,7 +66,8 @@ agg AS (
         -- Contratos pagos HOJE
         SUM(
             CASE 
-                WHEN DATE(data_pagamento) = CURRENT_DATE 
+                WHEN data_pagamento >= CURRENT_DATE
+                     AND data_pagamento <  CURRENT_DATE + 1
                      AND flag_paid = 1 
                 THEN 1 ELSE 0 
             END
@@ -87,7 +75,8 @@ agg AS (
 
         SUM(
             CASE 
-                WHEN DATE(data_pagamento) = CURRENT_DATE 
+                WHEN data_pagamento >= CURRENT_DATE
+                     AND data_pagamento <  CURRENT_DATE + 1
                      AND flag_paid = 1 
                 THEN OD.grossvalue ELSE 0 
             END
@@ -97,7 +86,8 @@ agg AS (
         SUM(
             CASE 
                 WHEN produto = 'REFIN'
-                     AND DATE(data_pagamento) = CURRENT_DATE 
+                     AND data_pagamento >= CURRENT_DATE
+                     AND data_pagamento <  CURRENT_DATE + 1
                      AND flag_paid = 1
                 THEN OD.valuefordeposit ELSE 0 
             END
@@ -107,7 +97,8 @@ agg AS (
         SUM(
             CASE 
                 WHEN produto = 'PORTABILITY'
-                     AND DATE(data_pagamento) = CURRENT_DATE 
+                     AND data_pagamento >= CURRENT_DATE
+                     AND data_pagamento <  CURRENT_DATE + 1
                      AND flag_paid = 1
                 THEN OD.outstandingbalance ELSE 0 
             END
@@ -116,14 +107,16 @@ agg AS (
         -- Base p/ % aproveitamento (dia)
         SUM(
             CASE 
-                WHEN DATE(OD.completeddate) = CURRENT_DATE 
+                WHEN OD.completeddate >= CURRENT_DATE
+                     AND OD.completeddate <  CURRENT_DATE + 1
                 THEN 1 ELSE 0 
             END
         ) AS base_dia,
 
         SUM(
             CASE 
-                WHEN DATE(OD.completeddate) = CURRENT_DATE 
+                WHEN OD.completeddate >= CURRENT_DATE
+                     AND OD.completeddate <  CURRENT_DATE + 1
                 THEN flag_paid ELSE 0 
             END
         ) AS pagos_dia,
@@ -131,14 +124,16 @@ agg AS (
         -- Base p/ % aproveitamento (mês)
         SUM(
             CASE 
-                WHEN DATE_TRUNC('month', OD.completeddate) = DATE_TRUNC('month', CURRENT_DATE)
+                WHEN OD.completeddate >= DATE_TRUNC('month', CURRENT_DATE)
+                     AND OD.completeddate <  DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'
                 THEN 1 ELSE 0 
             END
         ) AS base_mes,
 
         SUM(
             CASE 
-                WHEN DATE_TRUNC('month', OD.completeddate) = DATE_TRUNC('month', CURRENT_DATE)
+                WHEN OD.completeddate >= DATE_TRUNC('month', CURRENT_DATE)
+                     AND OD.completeddate <  DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'
                 THEN flag_paid ELSE 0 
             END
         ) AS pagos_mes
@@ -146,80 +141,59 @@ agg AS (
     GROUP BY produto
 )
 
+-- Sempre um bloco por produto, mesmo sem movimento no período (zeros / "-")
 SELECT
-    produto,
-    qtd_dia            AS quantidade,
-    grossvalue_dia     AS grossvalue,
+    p.produto,
+    COALESCE(a.qtd_dia, 0)          AS quantidade,
+    COALESCE(a.grossvalue_dia, 0)   AS grossvalue,
 
-    CASE WHEN produto = 'REFIN'       THEN valor_deposito_dia END AS valor_de_deposito,
-    CASE WHEN produto = 'PORTABILITY' THEN saldos_pagos_dia   END AS saldos_pagos,
+    CASE WHEN p.produto = 'REFIN'       THEN COALESCE(a.valor_deposito_dia, 0) END AS valor_de_deposito,
+    CASE WHEN p.produto = 'PORTABILITY' THEN COALESCE(a.saldos_pagos_dia, 0)   END AS saldos_pagos,
 
     -- % aproveitamento dia
     CASE 
-        WHEN base_dia > 0 
-        THEN ROUND(pagos_dia * 100.0 / base_dia, 2)
+        WHEN a.base_dia > 0 
+        THEN ROUND(a.pagos_dia * 100.0 / a.base_dia, 2)
         ELSE NULL 
     END AS perc_aproveitamento_dia,
 
     -- % aproveitamento mês
     CASE 
-        WHEN base_mes > 0 
-        THEN ROUND(pagos_mes * 100.0 / base_mes, 2)
+        WHEN a.base_mes > 0 
+        THEN ROUND(a.pagos_mes * 100.0 / a.base_mes, 2)
         ELSE NULL 
     END AS perc_aproveitamento_mes
 
-FROM agg
-ORDER BY produto;
+FROM (VALUES ('NEW'), ('PORTABILITY'), ('REFIN')) AS p(produto)
+LEFT JOIN agg a
+  ON a.produto = p.produto
+ORDER BY p.produto;
 """
 
-# ========== Infra de conexão (igual seus outros bots) ==========
-
-def wait_for_vpn_and_db(host: str, port: int = 5432, interval: int = 900):
-    """
-    interval = 900s = 15 minutos
-    """
-    print(f"[BOOT RESUMO] Verificando acesso ao DB ({host}:{port})...")
-
-    while True:
-        try:
-            with socket.create_connection((host, port), timeout=5):
-                print("[BOOT RESUMO] Banco/VPN acessível. Seguindo execução.")
-                return
-        except OSError:
-            agora = datetime.now(TZ).strftime("%d/%m/%Y %H:%M:%S")
-            print(f"[{agora}] Banco ainda inacessível (VPN desligada?). Nova tentativa em 15 minutos...")
-            time.sleep(interval)
-
-def run_query(sql: str) -> pd.DataFrame:
-    wait_for_vpn_and_db(DB_CFG["host"], DB_CFG["port"])
-
-    url = URL.create(
-        drivername="postgresql+psycopg2",
-        username=DB_CFG["user"],
-        password=DB_CFG["password"],
-        host=DB_CFG["host"],
-        port=DB_CFG["port"],
-        database=DB_CFG["dbname"],
-    )
-    engine = create_engine(url, pool_pre_ping=True)
-
-    with engine.begin() as conn:
-        df = pd.read_sql(text(sql), conn)
+# Tipos numéricos nativos (NUMERIC pode vir como Decimal/decimal128)
+DTYPES_RESUMO = {
+    "quantidade": "Int64",
+    "grossvalue": "float64",
+    "valor_de_deposito": "float64",
+    "saldos_pagos": "float64",
+    "perc_aproveitamento_dia": "float64",
+    "perc_aproveitamento_mes": "float64",
+}
 
-    engine.dispose()
-    return df
+# Troca "," <-> "." numa única passada (str.translate, em C)
+_BRL_TT = str.maketrans({",": ".", ".": ","})
 
 def format_brl(value) -> str:
-    if value is None:
+    if value is None or pd.isna(value):
         return "-"
     try:
         v = float(value)
     except Exception:
         return "-"
-    return ("R$ " + f"{v:,.2f}").replace(",", "X").replace(".", ",").replace("X", ".")
+    return ("R$ " + f"{v:,.2f}").translate(_BRL_TT)
 
 def format_pct(value) -> str:
-    if value is None:
+    if value is None or pd.isna(value):
         return "-"
     try:
         v = float(value)
@@ -229,90 +203,110 @@ def format_pct(value) -> str:
 
 # ========== Formatação e envio pro Slack ==========
 
-def send_resumo_to_slack(df: pd.DataFrame):
+# Um bloco por produto; REFIN e PORTABILITY têm uma linha a mais
+TPL_NEW = (
+    "*{produto}*\n"
+    "  • Quantidade: *{qtd}*\n"
+    "  • Grossvalue: {gross}\n"
+    "  • Aproveitamento (dia): {pct_dia}\n"
+    "  • Aproveitamento (mês): {pct_mes}"
+)
+TPL_REFIN = (
+    "*{produto}*\n"
+    "  • Quantidade: *{qtd}*\n"
+    "  • Grossvalue: {gross}\n"
+    "  • Valor Depósito: {valor_dep}\n"
+    "  • Aproveitamento (dia): {pct_dia}\n"
+    "  • Aproveitamento (mês): {pct_mes}"
+)
+TPL_PORT = (
+    "*{produto}*\n"
+    "  • Quantidade: *{qtd}*\n"
+    "  • Grossvalue: {gross}\n"
+    "  • Saldos Pagos: {saldos_pagos}\n"
+    "  • Aproveitamento (dia): {pct_dia}\n"
+    "  • Aproveitamento (mês): {pct_mes}"
+)
+TPL_POR_PRODUTO = {"REFIN": TPL_REFIN, "PORTABILITY": TPL_PORT}
+
+# Hash do último resumo enviado (em memória, por processo)
+_LAST_HASH: dict[str, str] = {}
+
+def send_resumo_to_slack(df: pd.DataFrame) -> bool:
+    """Retorna True só se a mensagem foi de fato postada no Slack."""
+    # Sem registros: não posta nada (evita spam de mensagens vazias)
+    if df.empty:
+        log.info("Sem registros para o dia atual. Post ignorado.")
+        return False
+
     agora = datetime.now(TZ).strftime("%d/%m/%Y %H:%M")
     header = (
         "*Resumo Diário Privado — Consignado Privado*\n"
         f"📅 {agora} (America/Fortaleza)\n\n"
     )
 
-    if df.empty:
-        text = header + "_Sem registros para o dia atual._"
-    else:
-        lines = []
-        for _, r in df.iterrows():
-            produto = str(r.get("produto", "")).upper()
-            qtd = int(r.get("quantidade") or 0)
-            gross = format_brl(r.get("grossvalue"))
-            valor_dep = format_brl(r.get("valor_de_deposito"))
-            saldos_pagos = format_brl(r.get("saldos_pagos"))
-            pct_dia = format_pct(r.get("perc_aproveitamento_dia"))
-            pct_mes = format_pct(r.get("perc_aproveitamento_mes"))
-
-            bloco = [f"*{produto}*"]
-            bloco.append(f"  • Quantidade: *{qtd}*")
-            bloco.append(f"  • Grossvalue: {gross}")
-
-            if produto == "REFIN":
-                bloco.append(f"  • Valor Depósito: {valor_dep}")
-            if produto == "PORTABILITY":
-                bloco.append(f"  • Saldos Pagos: {saldos_pagos}")
-
-            bloco.append(f"  • Aproveitamento (dia): {pct_dia}")
-            bloco.append(f"  • Aproveitamento (mês): {pct_mes}")
-
-            lines.append("\n".join(bloco))
-
-        text = header + "\n\n".join(lines)
-
-    r = requests.post(
+    lines = []
+    for r in df.itertuples(index=False):
+        produto = str(r.produto).upper()
+        tpl = TPL_POR_PRODUTO.get(produto, TPL_NEW)
+        lines.append(tpl.format(
+            produto=produto,
+            qtd=0 if pd.isna(r.quantidade) else int(r.quantidade),
+            gross=format_brl(r.grossvalue),
+            valor_dep=format_brl(r.valor_de_deposito),
+            saldos_pagos=format_brl(r.saldos_pagos),
+            pct_dia=format_pct(r.perc_aproveitamento_dia),
+            pct_mes=format_pct(r.perc_aproveitamento_mes),
+        ))
+
+    body = "\n\n".join(lines)
+
+    # Mesmo conteúdo do último resumo (ignorando o horário do header): não repete no Slack
+    h = hashlib.blake2b(body.encode(), digest_size=8).hexdigest()
+    if _LAST_HASH.get("resumo") == h:
+        log.info("Sem mudanças desde o último envio. Post ignorado.")
+        return False
+
+    r = _SLACK.post(
         "https://slack.com/api/chat.postMessage",
-        headers={"Authorization": f"Bearer {SLACK_TOKEN}"},
-        json={"channel": SLACK_CHANNEL, "text": text, "mrkdwn": True},
+        json={"channel": SLACK_CHANNEL, "text": header + body, "mrkdwn": True},
         timeout=20,
     )
 
     if not r.ok or not r.json().get("ok"):
-        print("[RESUMO] Erro ao enviar mensagem para o Slack:", r.text)
+        log.error("Erro ao enviar mensagem para o Slack: %s", r.text)
+        return False
+    _LAST_HASH["resumo"] = h
+    return True
 
 # ========== Job e agendamento ==========
 
 def job_resumo():
-    agora = datetime.now(TZ)
-    print(f"[{agora}] [RESUMO] Iniciando resumo diário...")
+    log.info("Iniciando resumo diário...")
     try:
-        df = run_query(SQL_RESUMO)
-        send_resumo_to_slack(df)
-        print(f"[{agora}] [RESUMO] Mensagem enviada com sucesso!")
-    except Exception as e:
-        print(f"[{agora}] [RESUMO] ❌ Erro: {e}")
-
-# Execução 2x por dia — segunda a sábado — 11:30 e 17:30
-schedule.every().monday.at("11:30").do(job_resumo)
-schedule.every().monday.at("17:30").do(job_resumo)
-
-schedule.every().tuesday.at("11:30").do(job_resumo)
-schedule.every().tuesday.at("17:30").do(job_resumo)
-
-schedule.every().wednesday.at("11:30").do(job_resumo)
-schedule.every().wednesday.at("17:30").do(job_resumo)
+        df = run_query(SQL_RESUMO, dtypes=DTYPES_RESUMO)
+        if send_resumo_to_slack(df):
+            log.info("Mensagem enviada com sucesso!")
+    except Exception:
+        log.exception("❌ Erro")
 
-schedule.every().thursday.at("11:30").do(job_resumo)
-schedule.every().thursday.at("17:30").do(job_resumo)
+# Host suspenso/ocupado no horário: roda atrasado (até 1h) em vez de descartar; atrasos acumulados viram 1 execução
+sched = BlockingScheduler(
+    timezone=TZ,
+    job_defaults={"misfire_grace_time": 3600, "coalesce": True},
+)
 
-schedule.every().friday.at("11:30").do(job_resumo)
-schedule.every().friday.at("17:30").do(job_resumo)
+# Execução 2x por dia — segunda a sábado — 11:30 e 17:30
+sched.add_job(job_resumo, CronTrigger(day_of_week="mon-sat", hour="11,17", minute=30, timezone=TZ))
 
-schedule.every().saturday.at("11:30").do(job_resumo)
-schedule.every().saturday.at("17:30").do(job_resumo)
+log.info("⏰ Bot 'Resumo Diário Privado' iniciado.")
+log.info("Executará 2x por dia (segunda a sábado): 11:30 e 17:30 (America/Fortaleza).")
 
-print("⏰ Bot 'Resumo Diário Privado' iniciado.")
-print("   Executará 2x por dia (segunda a sábado): 11:30 e 17:30 (America/Fortaleza).")
+# Garante VPN/DB uma única vez no boot (o pool cuida das reconexões)
+wait_for_vpn_and_db()
 
 # opcional: dispara uma vez ao iniciar para teste
 # comente esta linha se não quiser enviar na hora que subir o bot
 # job_resumo()
 
-while True:
-    schedule.run_pending()
-    time.sleep(30)
+sched.start()
@@ -1,5 +1,12 @@
 import os
+import json
+import time
+import base64
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
+from typing import Optional
+from urllib3.util.retry import Retry
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
@@ -13,11 +20,33 @@ CHART_ID = int(os.environ["SUPERSET_CHART_ID"])
 SLACK_BOT_TOKEN = os.environ["SLACK_BOT_TOKEN"]
 SLACK_CHANNEL_ID = os.environ["SLACK_CHANNEL_ID"]
 
+# Sessão HTTP única: reaproveita a conexão TCP/TLS entre login e consulta do chart
+SUPERSET_SESSION = requests.Session()
+SUPERSET_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    ),
+))
+
+# Cache do JWT do Superset: memória do processo + arquivo entre execuções
+# (diretório do próprio usuário, não o temp compartilhado)
+SUPERSET_TOKEN_CACHE = os.getenv(
+    "SUPERSET_TOKEN_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "mensageiro", "superset.jwt"),
+)
+_TOKEN_CACHE: dict = {}
+
 
 # ----- Superset helpers -----
 def get_superset_token() -> str:
     """Autentica no Superset e retorna o access_token (JWT)."""
-    resp = requests.post(
+    resp = SUPERSET_SESSION.post(
         f"{SUPERSET_URL}/api/v1/security/login",
         json={
             "provider": "db",
@@ -32,32 +61,109 @@ def get_superset_token() -> str:
     return data["access_token"]
 
 
-def get_chart_data(token: str, chart_id: int) -> dict:
-    """Busca os dados de um chart específico (id=chart_id)."""
+def _jwt_exp(token: str) -> float:
+    """Lê o campo exp do payload do JWT (sem validar assinatura)."""
+    payload = token.split(".")[1]
+    payload += "=" * (-len(payload) % 4)
+    return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+
+
+def get_superset_token_cached(path: str = SUPERSET_TOKEN_CACHE) -> str:
+    """
+    Reaproveita o JWT enquanto faltar mais de 60s para expirar.
+    Guarda em memória (processo) e em arquivo (entre execuções); só faz login se preciso.
+    O token só vale para o mesmo SUPERSET_URL + usuário que o gerou.
+    """
+    cached = dict(_TOKEN_CACHE)
+    if not cached:
+        try:
+            with open(path, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        if not isinstance(cached, dict):
+            cached = {}
+
+    if (
+        cached.get("url") == SUPERSET_URL
+        and cached.get("user") == SUPERSET_USERNAME
+        and cached.get("exp", 0) - time.time() > 60
+    ):
+        _TOKEN_CACHE.update(cached)
+        return cached["token"]
+
+    token = get_superset_token()
+    try:
+        exp = _jwt_exp(token)
+    except (KeyError, IndexError, ValueError, TypeError):
+        # Token sem exp (JWT_ACCESS_TOKEN_EXPIRES=False) ou fora do formato JWT: usa sem cachear
+        print("Token do Superset sem expiração legível; seguindo sem cache.")
+        return token
+
+    cached = {"token": token, "exp": exp, "url": SUPERSET_URL, "user": SUPERSET_USERNAME}
+    _TOKEN_CACHE.clear()
+    _TOKEN_CACHE.update(cached)
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # O_NOFOLLOW: não segue symlink plantado no lugar do arquivo de cache
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0)
+        fd = os.open(path, flags, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cached, f)
+    except OSError as e:
+        print(f"Não foi possível salvar o token em cache ({path}): {e}")
+    return token
+
+
+def invalidar_token_cache(path: str = SUPERSET_TOKEN_CACHE):
+    """Descarta o JWT em cache (memória e arquivo), p/ forçar novo login."""
+    _TOKEN_CACHE.clear()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Não foi possível remover o token em cache ({path}): {e}")
+
+
+def contar_registros_chart(token: str, chart_id: int) -> Optional[int]:
+    """
+    Conta as linhas do 1º resultado do chart (id=chart_id) lendo o JSON em streaming,
+    sem montar a lista de registros em memória. Retorna None se o chart não trouxer resultado.
+    """
     headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(
+    with SUPERSET_SESSION.get(
         f"{SUPERSET_URL}/api/v1/chart/{chart_id}/data",
         headers=headers,
         timeout=60,
-    )
-    resp.raise_for_status()
-    return resp.json()
+        stream=True,
+    ) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+
+        resultados = 0
+        registros = 0
+        for prefix, event, _ in ijson.parse(resp.raw):
+            if prefix == "result.item":
+                if event == "start_map":
+                    resultados += 1
+                elif event == "end_map":
+                    break  # só o 1º resultado interessa
+            elif prefix == "result.item.data.item" and event in ("start_map", "start_array"):
+                registros += 1
+
+    return registros if resultados else None
 
 
 # ----- Regras de negócio / mensagem -----
-def processar(chart_data: dict) -> str:
+def processar(total_registros: Optional[int]) -> str:
     """
-    Recebe o JSON do Superset e monta o texto pro Slack.
+    Recebe a contagem de registros do chart e monta o texto pro Slack.
     Depois a gente adapta com sua lógica real (SLA, esteiras, etc.).
     """
-    results = chart_data.get("result", [])
-    if not results:
+    if total_registros is None:
         return "⚠ Nenhum dado retornado pelo chart 5840."
 
-    data = results[0].get("data", [])
-
-    total_registros = len(data)
-
     mensagem = (
         f"*Monitoramento automático via Superset*\n"
         f"- Chart ID: `5840`\n"
@@ -84,13 +190,22 @@ def enviar_slack(texto: str):
 # ----- Main -----
 def main():
     print("Autenticando no Superset...")
-    token = get_superset_token()
+    token = get_superset_token_cached()
 
     print("Buscando dados do chart...")
-    chart_data = get_chart_data(token, CHART_ID)
+    try:
+        total_registros = contar_registros_chart(token, CHART_ID)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 401:
+            raise
+        # Token em cache rejeitado (revogado/trocado): novo login e uma única nova tentativa
+        print("Token do Superset rejeitado (401). Autenticando novamente...")
+        invalidar_token_cache()
+        token = get_superset_token_cached()
+        total_registros = contar_registros_chart(token, CHART_ID)
 
     print("Processando resultados...")
-    mensagem = processar(chart_data)
+    mensagem = processar(total_registros)
 
     print("Enviando mensagem pro Slack...")
     enviar_slack(mensagem)
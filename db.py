@@ -0,0 +1,137 @@
+import os
+import logging
+import time
+import random
+import socket
+import threading
+from typing import TYPE_CHECKING, Optional
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Row
+from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import OperationalError
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# ============================================
+# Infra de conexão compartilhada pelos bots (Postgres via VPN)
+# ============================================
+
+log = logging.getLogger(__name__)
+
+# === Carrega variáveis do .env ===
+load_dotenv()
+
+DB_CFG = {
+    "host": os.getenv("DB_HOST"),
+    "port": int(os.getenv("DB_PORT", 5432)),
+    "dbname": os.getenv("DB_NAME"),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+}
+
+# === Engine único (pool reaproveitado entre as execuções) ===
+DB_URL = URL.create(
+    drivername="postgresql+psycopg",
+    username=DB_CFG["user"],
+    password=DB_CFG["password"],
+    host=DB_CFG["host"],
+    port=DB_CFG["port"],
+    database=DB_CFG["dbname"],
+)
+ENGINE = create_engine(
+    DB_URL,
+    pool_size=3,
+    max_overflow=2,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    future=True,
+    # psycopg3 prepara o statement no servidor já na 1ª execução (plano reaproveitado na conexão)
+    connect_args={"prepare_threshold": 0},
+)
+
+# URI "postgresql://..." usada pelos leitores Arrow (connectorx / ADBC)
+DB_URI = DB_URL.set(drivername="postgresql").render_as_string(hide_password=False)
+
+# Sinaliza "DB acessível" para todos os jobs; só uma thread faz o probe por vez.
+# Uma vez setado, nenhuma consulta paga o probe TCP até alguma falhar e limpar o evento.
+_DB_READY = threading.Event()
+_PROBE_LOCK = threading.Lock()
+
+def wait_for_vpn_and_db(host: str = DB_CFG["host"], port: int = DB_CFG["port"], max_delay: int = 300):
+    """
+    Backoff exponencial com jitter: 5s, 10s, 20s... até max_delay (300s = 5 minutos).
+    """
+    if _DB_READY.is_set():
+        return
+
+    if not _PROBE_LOCK.acquire(blocking=False):
+        # Outro job já está testando a conexão: só espera o resultado
+        _DB_READY.wait()
+        return
+
+    try:
+        log.info("Verificando acesso ao DB (%s:%s)...", host, port)
+        delay = 5
+        while True:
+            try:
+                with socket.create_connection((host, port), timeout=2):
+                    log.info("Banco/VPN acessível. Seguindo execução.")
+                    _DB_READY.set()
+                    return
+            except OSError:
+                espera = delay + random.uniform(0, delay / 2)
+                log.warning("Banco ainda inacessível (VPN desligada?). Nova tentativa em %.0fs...", espera)
+                time.sleep(espera)
+                delay = min(delay * 2, max_delay)
+    finally:
+        _PROBE_LOCK.release()
+
+# === Consulta -> DataFrame (leitor Arrow) ===
+def run_query(sql: str, dtypes: Optional[dict] = None) -> "pd.DataFrame":
+    """
+    dtypes: {coluna: dtype} aplicado logo após a leitura (ex.: NUMERIC -> float64).
+    pandas e o leitor Arrow são importados aqui: quem só usa run_query_rows
+    (bot de monitoramento) precisa apenas do SQLAlchemy.
+    """
+    import pandas as pd
+
+    # Leitura direta em Arrow (sem tuplas Python por linha): connectorx, ou ADBC como alternativa
+    try:
+        import connectorx as cx
+    except ImportError:
+        cx = None
+        from adbc_driver_postgresql import dbapi as adbc_pg
+
+    wait_for_vpn_and_db()
+
+    sql = sql.strip().rstrip(";")
+    try:
+        if cx is not None:
+            df = cx.read_sql(DB_URI, sql, return_type="pandas")
+        else:
+            with adbc_pg.connect(DB_URI) as conn, conn.cursor() as cur:
+                cur.execute(sql)
+                df = cur.fetch_arrow_table().to_pandas(types_mapper=pd.ArrowDtype)
+    except Exception:
+        # Falhou: força um novo probe da VPN/DB na próxima consulta
+        _DB_READY.clear()
+        raise
+
+    for col, dtype in (dtypes or {}).items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+    return df
+
+# === Consulta -> Rows (poucas linhas: sem montar DataFrame) ===
+def run_query_rows(stmt, **params) -> list[Row]:
+    wait_for_vpn_and_db()
+
+    try:
+        with ENGINE.connect() as conn:
+            return conn.execute(stmt, params).fetchall()
+    except OperationalError:
+        # Conexão caiu: força um novo probe da VPN/DB na próxima consulta
+        _DB_READY.clear()
+        raise
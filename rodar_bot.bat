@@ -5,6 +5,8 @@ cd C:\Users\carlos.rossatti_meut\monitoramento_esteiras
 REM === ativar o ambiente virtual ===
 call venv\Scripts\activate
 
+REM === dependências (uma vez, ou após atualizar o repo): pip install -r requirements-bots.txt ===
+
 REM === rodar o bot ===
 python bot_monitoramento.py
 
@@ -0,0 +1,66 @@
+-- =====================================================================
+-- gold.mv_cor_contrato_pagamentos
+-- Contratos do consignado privado (agreementid = '10') já com flag_paid,
+-- data_pagamento e produto normalizado. Usada pelo bot_resumo_diario.py.
+--
+-- DEPLOY: rodar este arquivo no banco ANTES de subir a versão do
+-- bot_resumo_diario.py que lê desta view (sem ela o SQL_RESUMO falha).
+-- Requer a extensão pg_cron (refresh agendado de hora em hora, no fim do arquivo).
+--
+-- Atualização: de hora em hora, no banco (o bot só lê). Os números "pagos HOJE"
+-- podem estar até 1h defasados no horário do resumo.
+--
+-- Sem REFRESH CONCURRENTLY: não há chave única conhecida em
+-- cor_contrato_operacoes_movimento (pode haver mais de uma linha por contractid),
+-- então não dá para criar o índice único exigido. O REFRESH comum segura um lock
+-- ACCESS EXCLUSIVE na view enquanto roda; leitores esperam até ele terminar.
+-- =====================================================================
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS gold.mv_cor_contrato_pagamentos AS
+SELECT
+    OD.contractid,
+
+    -- Flag contrato pago
+    CASE
+        WHEN OD.info_etapa IN ('5. Pago','6. Pago','7. Pago') THEN 1
+        ELSE 0
+    END AS flag_paid,
+
+    -- Data de pagamento
+    CASE
+        WHEN OD.loanstatus = 'PAID' AND OD.prod = 'PORTABILITY' THEN OD.paid_date
+        WHEN OD.loanstatus = 'PAID' AND OD.paymentdate IS NULL THEN OD.paid_date
+        ELSE OD.paymentdate - INTERVAL '3 hour'
+    END AS data_pagamento,
+
+    -- Produto normalizado
+    CASE
+        WHEN OD.prod IN ('PIX_CONSIGNED','FUTUREMARGIN','NEW_PRIVATE_CONSIGNMENT') THEN 'NEW'
+        WHEN OD.prod IN ('REFIN_PRIVATE_CONSIGNMENT') THEN 'REFIN'
+        WHEN OD.prod IN ('PORTABILITY','PORTABILITY_PRIVATE_CONSIGNMENT') THEN 'PORTABILITY'
+        ELSE OD.prod
+    END AS produto,
+
+    OD.grossvalue,
+    OD.valuefordeposit,
+    OD.outstandingbalance,
+    OD.completeddate
+FROM gold.cor_contrato_operacoes_movimento OD
+JOIN gold.tudoprod_contract cc
+  ON cc.contractid = OD.contractid
+JOIN gold.tudoprod_enrollment ee
+  ON ee.id = cc.enrollmentid
+WHERE ee.agreementid = '10';          -- consignado privado
+
+-- Faixas de data usadas pelo resumo (dia / mês corrente)
+CREATE INDEX IF NOT EXISTS mv_cor_contrato_pagamentos_completeddate_idx
+    ON gold.mv_cor_contrato_pagamentos (completeddate);
+CREATE INDEX IF NOT EXISTS mv_cor_contrato_pagamentos_data_pagamento_idx
+    ON gold.mv_cor_contrato_pagamentos (data_pagamento);
+
+-- Atualização de hora em hora (pg_cron), no minuto 0
+SELECT cron.schedule(
+    'refresh_mv_cor_contrato_pagamentos',
+    '0 * * * *',
+    'REFRESH MATERIALIZED VIEW gold.mv_cor_contrato_pagamentos'
+);